@@ -0,0 +1,42 @@
+"""
+Generate pre-tokenized training corpora by ancestral sampling from each chain
+"""
+
+import sys
+from pgmpy.readwrite import XMLBIFReader
+from transformers import GPT2Tokenizer
+from pyprojroot import here
+from src.corpus import sample_corpus, write_corpus_shards
+
+fixed_args = {
+    "n_samples": 10_000_000,
+    "chunk_size": 1_000_000,
+    "sample_type": "local-pair",
+    "random_seed": 0,
+}
+
+variable_args = [
+    {
+        "true_model_path": f"data/chains/chain_{i}.xbn",
+        "corpus_dir": f"data/corpora/chain-{i}_local-pair",
+    }
+    for i in range(4)
+]
+
+if __name__ == "__main__":
+
+    i = int(sys.argv[1])
+    args = {**fixed_args, **variable_args[i]}
+    true_model = XMLBIFReader(here(args["true_model_path"])).get_model()
+    tokenizer = GPT2Tokenizer(
+        here("data/tokenizer/vocab.json"), here("data/tokenizer/merges.txt")
+    )
+    chunks = sample_corpus(
+        true_model,
+        tokenizer,
+        args["n_samples"],
+        sample_type=args["sample_type"],
+        chunk_size=args["chunk_size"],
+        random_seed=args["random_seed"],
+    )
+    write_corpus_shards(chunks, here(".") / args["corpus_dir"])
@@ -4,10 +4,16 @@ Evaluate models with a range of parameters
 
 import os
 import sys
-from src.evaluate import run_evaluation
 from pyprojroot import here
 
-fixed_args = {}
+fixed_args = {
+    "estimators": ["direct_pred", "markovian_scaff_gen", "full_scaff_gen", "free_gen"],
+    # set to True to evaluate with an int8 dynamically quantized model on the CPU
+    "quantize": False,
+    # estimates are cached by the hashes of their inputs, so unchanged work is skipped on re-runs
+    "cache_path": "data/cache/evaluation.sqlite",
+    "cache_max_entries": 100_000,
+}
 
 variable_args_one_step = [
     {
@@ -48,12 +54,28 @@ for random_seed in range(start_seed, start_seed + n_seeds):
         variable_args.append({**args, "random_seed": random_seed})
         variable_args[-1]["model_name"] += f"_seed-{random_seed}_criterion"
 
-if __name__ == "__main__":
 
-    i = int(sys.argv[1])
-    args = variable_args[i]
+def run_point(i):
+    """
+    Evaluate the model at one point of the grid. Returns False if the model hasn't been trained yet.
+    """
+    args = {**fixed_args, **variable_args[i]}
+    # results are flushed here chunk by chunk, so a restarted job picks up where it left off
+    args["checkpoint_dir"] = f"data/checkpoints/evaluation_model-{args['model_name']}"
     if os.path.exists(f"{os.environ['MODELS_DIR']}/{args['model_name']}"):
-        df_results = run_evaluation({**fixed_args, **args})
+        from src.evaluate import run_evaluation, run_quantization_parity_check
+
+        df_results = run_evaluation(args)
         df_results.to_csv(here(f"data/results/evaluation_model-{args['model_name']}.csv"), index=False)
+        if args["quantize"]:
+            df_parity = run_quantization_parity_check(args)
+            df_parity.to_csv(here(f"data/results/quantization-parity_model-{args['model_name']}.csv"), index=False)
+            print(f"max int8 vs fp32 readout difference: {df_parity['abs_diff'].max():.4f}")
     else:
         print(f"model not found: {args['model_name']}")
+        return False
+
+
+if __name__ == "__main__":
+
+    run_point(int(sys.argv[1]))
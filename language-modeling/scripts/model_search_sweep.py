@@ -0,0 +1,73 @@
+"""
+Search for training hyperparameters that reach criterion quickly, using successive halving with an
+iteration and time budget per config
+"""
+
+import sys
+from itertools import product
+from torch.optim import Adam
+from torch.optim.lr_scheduler import LinearLR
+import pandas as pd
+from pyprojroot import here
+from src.search import successive_halving
+
+fixed_args = {
+    "optimizer": Adam,
+    "scheduler": LinearLR,
+    "scheduler_args": {},
+    "training_dataset_type": "batch-with-separator",
+    "criterion_threshold": 0.9,
+    "random_seed": 2024,
+}
+
+search_args = {
+    "min_iterations": 100,
+    "max_iterations": 6400,
+    "eta": 2,
+    "max_seconds": 2 * 60 * 60,
+}
+
+learning_rates = [1e-5, 5e-5, 1e-4, 5e-4]
+model_configs = [
+    {"vocab_size": 257, "n_positions": 512, "n_embd": n_embd, "n_layer": n_layer, "n_head": n_head}
+    for n_embd, n_layer, n_head in [(128, 4, 2), (256, 4, 2), (256, 8, 2), (256, 8, 4), (512, 8, 4)]
+]
+
+variable_args = [
+    {"true_model_path": f"data/chains/chain_{i}.xbn", "chain": i} for i in range(4)
+]
+
+
+def run_point(i):
+    """
+    Run the hyperparameter search for one chain
+    """
+    args = variable_args[i]
+    configs = [
+        {
+            **fixed_args,
+            "true_model_path": args["true_model_path"],
+            "model_config": model_config,
+            "optimizer_args": {"lr": lr},
+        }
+        for lr, model_config in product(learning_rates, model_configs)
+    ]
+    results = successive_halving(configs, **search_args)
+
+    df_results = pd.DataFrame(
+        [
+            {
+                **result,
+                "lr": configs[result["config_idx"]]["optimizer_args"]["lr"],
+                **configs[result["config_idx"]]["model_config"],
+            }
+            for result in results
+        ]
+    )
+    df_results.to_csv(here(f"data/results/search_chain-{args['chain']}.csv"), index=False)
+    print(df_results)
+
+
+if __name__ == "__main__":
+
+    run_point(int(sys.argv[1]))
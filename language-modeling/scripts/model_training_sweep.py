@@ -22,6 +22,8 @@ fixed_args = {
     "criterion": True,
     "training_dataset_type": "batch-with-separator",
     "criterion_threshold": 0.9,
+    # stop before the SLURM time limit, saving the model as incomplete if it hasn't reached criterion
+    "max_seconds": 23 * 60 * 60,
 }
 
 variable_args_one_step = [
@@ -52,8 +54,14 @@ for random_seed in range(start_seed, start_seed + n_seeds):
         variable_args.append({**args, "random_seed": random_seed})
         variable_args[-1]["model_name"] += f"_seed-{random_seed}"
 
+
+def run_point(i):
+    """
+    Train the model at one point of the grid
+    """
+    train_model({**fixed_args, **variable_args[i]})
+
+
 if __name__ == "__main__":
 
-    i = sys.argv[1]
-    args = variable_args[int(i)]
-    train_model({**fixed_args, **args})
+    run_point(int(sys.argv[1]))
@@ -0,0 +1,26 @@
+#!/bin/zsh
+#SBATCH --job-name=evaluation_workers
+#SBATCH --account=cocoflops
+#SBATCH --partition=cocoflops
+#SBATCH --nodelist=cocoflops1
+#SBATCH --array=0-3
+#SBATCH --nice=1000
+#SBATCH --output=slurm-output/eval_worker_%a.log
+#SBATCH --error=slurm-output/eval_worker_%a.log
+#SBATCH --nodes=1
+#SBATCH --ntasks-per-node=1
+#SBATCH --cpus-per-task=1
+#SBATCH --gres=gpu:1
+#SBATCH --time=24:00:00
+
+# Each task is a persistent worker that pulls grid points from a shared queue until none are left.
+# Points left unfinished by preempted workers, and points whose model isn't trained yet, are picked
+# up again when the sweep is relaunched. Points that raised are marked <i>.failed in
+# data/queue/evaluation; delete those markers (or <i>.done, to re-run a finished point) to retry them.
+
+source ~/.zshrc
+
+cd ~/reasoning-in-chains
+
+conda activate reasoning-chains
+python scripts/sweep_worker.py evaluation
@@ -0,0 +1,185 @@
+"""
+A persistent worker that imports the heavy libraries once and then works through the points of a
+sweep, claiming one grid index at a time from a queue shared by all workers. The queue is a directory
+on a shared filesystem: a worker claims index i by atomically creating the file "i.claimed", and
+writes "i.done" once the point has finished, so several workers (e.g. the tasks of a SLURM array)
+never run the same point twice. A point that raises is marked "i.failed" (with its traceback) and
+the worker moves on; delete the marker to retry the point.
+
+While a worker runs a point it keeps touching its claim file. A claim that isn't done and whose
+worker has died (on the same host) or stopped touching it for longer than the lease is stale, and
+another worker reclaims the point, so points from preempted or crashed workers are retried.
+
+Usage: python scripts/sweep_worker.py <evaluation|training> [queue_dir]
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import traceback
+import importlib
+from pyprojroot import here
+
+SWEEP_MODULES = {
+    "evaluation": "model_evaluation_sweep",
+    "training": "model_training_sweep",
+}
+
+LEASE_SECONDS = 10 * 60
+HEARTBEAT_SECONDS = 60
+
+
+def _read_claim(claim_path):
+    """
+    Read a claim file together with its stat, taken from the same open file so that both describe
+    the same claim. Returns None if there is no claim.
+    """
+    try:
+        with open(claim_path) as f:
+            return os.fstat(f.fileno()), f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _is_stale(claim_stat, claim_text, lease_seconds):
+    """
+    Check whether the worker holding a claim is gone: either it hasn't renewed the claim within the
+    lease, or its process no longer exists on this host
+    """
+    if time.time() - claim_stat.st_mtime > lease_seconds:
+        return True
+    try:
+        claim = json.loads(claim_text)
+    except json.JSONDecodeError:
+        # the claim is still being written
+        return False
+    if claim["host"] == socket.gethostname():
+        try:
+            os.kill(claim["pid"], 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+    return False
+
+
+def _move_stale_claim(claim_path, claim_stat):
+    """
+    Move a stale claim out of the way, returning whether it was moved. Another worker may have
+    reclaimed the point in the meantime, so the moved file is checked against the stale claim and
+    put back if it is a different one.
+    """
+    moved_path = f"{claim_path}.stale-{socket.gethostname()}-{os.getpid()}-{time.time_ns()}"
+    try:
+        os.rename(claim_path, moved_path)
+    except FileNotFoundError:
+        return False
+    moved_stat = os.stat(moved_path)
+    if (moved_stat.st_ino, moved_stat.st_mtime_ns) == (claim_stat.st_ino, claim_stat.st_mtime_ns):
+        return True
+    # linking never replaces a claim created since the rename
+    try:
+        os.link(moved_path, claim_path)
+    except FileExistsError:
+        pass
+    os.remove(moved_path)
+    return False
+
+
+def claim_next_index(queue_dir, n_points, lease_seconds=LEASE_SECONDS, skip=()):
+    """
+    Claim the first grid index that isn't done, hasn't failed, isn't in skip and isn't claimed by a
+    live worker, or return None if there is no such index
+    """
+    for i in range(n_points):
+        if i in skip or any(
+            os.path.exists(os.path.join(queue_dir, f"{i}.{marker}")) for marker in ("done", "failed")
+        ):
+            continue
+        claim_path = os.path.join(queue_dir, f"{i}.claimed")
+        claim = _read_claim(claim_path)
+        if claim is not None:
+            if not _is_stale(*claim, lease_seconds) or not _move_stale_claim(claim_path, claim[0]):
+                continue
+        try:
+            fd = os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            continue
+        os.write(fd, json.dumps({"host": socket.gethostname(), "pid": os.getpid()}).encode())
+        os.close(fd)
+        return i
+    return None
+
+
+def run_claimed_point(sweep, queue_dir, i, heartbeat_seconds=HEARTBEAT_SECONDS):
+    """
+    Run a claimed grid point, renewing the claim while it runs. The point is marked done when it
+    finishes, unless run_point returns False to say that it had nothing to run yet, in which case the
+    claim is released. If the point fails, it is marked failed, with the traceback, and the error is
+    re-raised. Returns whether the point was marked done.
+    """
+    claim_path = os.path.join(queue_dir, f"{i}.claimed")
+    finished = threading.Event()
+
+    def renew_claim():
+        while not finished.wait(heartbeat_seconds):
+            try:
+                os.utime(claim_path)
+            except FileNotFoundError:
+                return
+
+    heartbeat = threading.Thread(target=renew_claim, daemon=True)
+    heartbeat.start()
+    try:
+        ran = sweep.run_point(i) is not False
+    except Exception:
+        finished.set()
+        heartbeat.join()
+        with open(os.path.join(queue_dir, f"{i}.failed"), "w") as f:
+            f.write(traceback.format_exc())
+        os.remove(claim_path)
+        raise
+    except BaseException:
+        finished.set()
+        os.remove(claim_path)
+        raise
+    finished.set()
+    heartbeat.join()
+    if not ran:
+        os.remove(claim_path)
+        return False
+    with open(os.path.join(queue_dir, f"{i}.done"), "w") as f:
+        f.write(f"{socket.gethostname()}:{os.getpid()}\n")
+    return True
+
+
+if __name__ == "__main__":
+
+    sweep_name = sys.argv[1]
+    queue_dir = sys.argv[2] if len(sys.argv) > 2 else here(".") / f"data/queue/{sweep_name}"
+    os.makedirs(queue_dir, exist_ok=True)
+
+    # the sweep scripts live next to this one, so they can be imported as modules
+    sweep = importlib.import_module(SWEEP_MODULES[sweep_name])
+
+    # import the heavy libraries once, up front, instead of once per grid point
+    import torch  # noqa: F401
+    import pandas  # noqa: F401
+    import pgmpy.inference  # noqa: F401
+    import transformers.models.gpt2  # noqa: F401
+    import src.reasoning_model  # noqa: F401
+    import src.estimator  # noqa: F401
+
+    # points this worker found nothing to run for, which are left for a later launch
+    skipped = set()
+    while (i := claim_next_index(queue_dir, len(sweep.variable_args), skip=skipped)) is not None:
+        print(f"running {sweep_name} point {i}")
+        try:
+            if not run_claimed_point(sweep, queue_dir, i):
+                skipped.add(i)
+        except Exception:
+            traceback.print_exc()
+            print(f"{sweep_name} point {i} failed, see {queue_dir}/{i}.failed")
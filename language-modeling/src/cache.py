@@ -0,0 +1,112 @@
+"""
+A content-addressed cache of evaluation results, so that re-running an evaluation only recomputes the
+estimates whose inputs (model weights, query, estimator config or code) have changed
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+
+def hash_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(path) -> str:
+    """
+    Hash the contents of a file, reading it in chunks
+    """
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def hash_directory(path) -> str:
+    """
+    Hash the names and contents of every file in a directory (e.g. a saved model)
+    """
+    sha = hashlib.sha256()
+    for file_path in sorted(Path(path).rglob("*")):
+        if file_path.is_file():
+            sha.update(str(file_path.relative_to(path)).encode())
+            sha.update(hash_file(file_path).encode())
+    return sha.hexdigest()
+
+
+def hash_code() -> str:
+    """
+    Hash the source code of the src package, so that cached results are invalidated by code changes
+    """
+    sha = hashlib.sha256()
+    for file_path in sorted(Path(__file__).parent.glob("*.py")):
+        sha.update(file_path.name.encode())
+        sha.update(file_path.read_bytes())
+    return sha.hexdigest()
+
+
+def hash_config(config) -> str:
+    """
+    Hash a JSON-serializable configuration, independently of key order
+    """
+    return hash_bytes(json.dumps(config, sort_keys=True).encode())
+
+
+class EvaluationCache:
+    """
+    A cache of JSON-serializable values stored in a SQLite database, keyed by content hashes. Once
+    the cache holds more than max_entries values, the least recently used ones are evicted.
+    """
+    def __init__(self, path, max_entries=100_000):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT, last_used REAL)"
+        )
+        self.max_entries = max_entries
+
+    def get_many(self, keys) -> dict:
+        """
+        Get the cached values for the keys that are in the cache, marking them as recently used
+        """
+        keys = list(keys)
+        values = {}
+        # SQLite limits the number of parameters in a single query
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT key, value FROM entries WHERE key IN ({placeholders})", chunk
+            ).fetchall()
+            values.update({key: json.loads(value) for key, value in rows})
+            self.connection.execute(
+                f"UPDATE entries SET last_used = ? WHERE key IN ({placeholders})",
+                [time.time(), *chunk],
+            )
+        self.connection.commit()
+        return values
+
+    def put_many(self, items: dict):
+        """
+        Store several values, then evict the least recently used entries if the cache is too large
+        """
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO entries (key, value, last_used) VALUES (?, ?, ?)",
+            [(key, json.dumps(value), now) for key, value in items.items()],
+        )
+        self.connection.execute(
+            "DELETE FROM entries WHERE key IN "
+            "(SELECT key FROM entries ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+        self.connection.commit()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,148 @@
+"""
+Generate large synthetic training corpora by ancestral sampling from a Bayes net, and store them as
+pre-tokenized shards on disk that can be read back through memory mapping
+"""
+import os
+import networkx as nx
+import numpy as np
+from pgmpy.models import BayesianNetwork
+from src.utils import get_rng
+
+
+def get_adjacent_pairs(true_model: BayesianNetwork) -> list:
+    """
+    Get every (observed, query) pair of adjacent variables, in both directions
+    """
+    pairs = []
+    for node in true_model.nodes():
+        if len(true_model.get_parents(node)) == 0:
+            continue
+        parent = true_model.get_parents(node)[0]
+        pairs.append((parent, node))
+        pairs.append((node, parent))
+    return pairs
+
+
+def ancestral_sample(true_model: BayesianNetwork, n_samples: int, rng: np.random.Generator) -> dict:
+    """
+    Draw joint samples from a Bayes net, sampling each variable given its parents in topological
+    order. Returns a dictionary mapping each variable to an array of sampled state indices.
+    """
+    samples = {}
+    for node in nx.topological_sort(true_model):
+        cpd = true_model.get_cpds(node)
+        values = cpd.get_values()
+
+        # find the column of the CPD for each sample from the parents' sampled states
+        column = np.zeros(n_samples, dtype=np.int64)
+        for parent, parent_card in zip(cpd.variables[1:], cpd.cardinality[1:]):
+            column = column * parent_card + samples[parent]
+
+        # sample by inverting the cumulative distribution in each column
+        cumulative_probs = np.cumsum(values[:, column], axis=0)
+        draws = (rng.random(n_samples) > cumulative_probs).sum(axis=0)
+        samples[node] = np.minimum(draws, cpd.cardinality[0] - 1)
+
+    return samples
+
+
+def _encode_assignments(true_model, tokenizer, variables, samples, separator="\n"):
+    """
+    Tokenize the assignments "var=val" of the given variables for every sample without building any
+    strings. Returns a 2D array with one row of tokens per sample.
+    """
+    columns = []
+    for i, var in enumerate(variables):
+        prefix = (separator if i > 0 else "") + f"{var}="
+        prefix_tokens = tokenizer.encode(prefix)
+        columns.append(np.tile(prefix_tokens, (len(samples[var]), 1)))
+
+        state_tokens = [tokenizer.encode(state) for state in true_model.get_cpds(var).state_names[var]]
+        if len({len(tokens) for tokens in state_tokens}) != 1:
+            raise ValueError(f"States of {var} do not all encode to the same number of tokens")
+        columns.append(np.array(state_tokens)[samples[var]])
+
+    return np.hstack(columns).astype(np.uint16)
+
+
+def sample_corpus(
+    true_model: BayesianNetwork,
+    tokenizer,
+    n_samples: int,
+    sample_type="local-pair",
+    chunk_size=100_000,
+    random_seed=0,
+):
+    """
+    Stream a pre-tokenized corpus of samples from a Bayes net, one chunk at a time. Each chunk is a
+    list of 2D token arrays, one per sample layout. Joint samples assign every variable in topological
+    order; local-pair samples pick an adjacent pair of variables ("X=x\\nY=y") from each joint sample.
+    """
+    pairs = get_adjacent_pairs(true_model)
+    variables = list(nx.topological_sort(true_model))
+    for chunk_idx, start in enumerate(range(0, n_samples, chunk_size)):
+        rng = get_rng(random_seed, "corpus", chunk_idx)
+        n_chunk = min(chunk_size, n_samples - start)
+        samples = ancestral_sample(true_model, n_chunk, rng)
+
+        if sample_type == "joint":
+            yield [_encode_assignments(true_model, tokenizer, variables, samples)]
+        elif sample_type == "local-pair":
+            chosen_pairs = rng.integers(len(pairs), size=n_chunk)
+            chunk = []
+            for pair_idx, pair in enumerate(pairs):
+                in_pair = chosen_pairs == pair_idx
+                if in_pair.any():
+                    pair_samples = {var: samples[var][in_pair] for var in pair}
+                    chunk.append(_encode_assignments(true_model, tokenizer, pair, pair_samples))
+            yield chunk
+        else:
+            raise ValueError(f"Unknown sample type: {sample_type}")
+
+
+def write_corpus_shards(chunks, out_dir):
+    """
+    Write each chunk of tokenized samples to its own shard, stored as a flat token array plus the
+    offsets at which each sample starts
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    for shard_idx, chunk in enumerate(chunks):
+        tokens = np.concatenate([rows.reshape(-1) for rows in chunk])
+        lengths = np.concatenate([np.full(len(rows), rows.shape[1]) for rows in chunk])
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        np.save(os.path.join(out_dir, f"shard-{shard_idx:05d}_tokens.npy"), tokens)
+        np.save(os.path.join(out_dir, f"shard-{shard_idx:05d}_offsets.npy"), offsets)
+
+
+class ShardedCorpus:
+    """
+    A pre-tokenized corpus written by write_corpus_shards, read lazily through memory mapping
+    """
+    def __init__(self, corpus_dir):
+        shard_names = sorted(
+            f[: -len("_tokens.npy")] for f in os.listdir(corpus_dir) if f.endswith("_tokens.npy")
+        )
+        self.tokens = [
+            np.load(os.path.join(corpus_dir, f"{name}_tokens.npy"), mmap_mode="r")
+            for name in shard_names
+        ]
+        self.offsets = [
+            np.load(os.path.join(corpus_dir, f"{name}_offsets.npy"), mmap_mode="r")
+            for name in shard_names
+        ]
+        self.shard_starts = np.cumsum([0] + [len(offsets) - 1 for offsets in self.offsets])
+
+    def __len__(self):
+        return int(self.shard_starts[-1])
+
+    def __getitem__(self, idx):
+        shard_idx = np.searchsorted(self.shard_starts, idx, side="right") - 1
+        local_idx = idx - self.shard_starts[shard_idx]
+        offsets = self.offsets[shard_idx]
+        return np.asarray(self.tokens[shard_idx][offsets[local_idx]:offsets[local_idx + 1]])
+
+    def sample(self, n_samples, rng: np.random.Generator) -> list:
+        """
+        Draw token arrays for n_samples samples uniformly at random, with replacement
+        """
+        return [self[idx] for idx in rng.integers(len(self), size=n_samples)]
@@ -1,6 +1,10 @@
+import copy
+from collections import OrderedDict
 import networkx as nx
-from random import random
-from src.utils import get_probability_from_logits
+import numpy as np
+import torch
+import torch.nn.functional as F
+from src.utils import get_probability_from_logits, get_rng
 from src.reasoning_model import ReasoningModel
 from pgmpy.models import BayesianNetwork
 
@@ -12,14 +16,22 @@ def get_scaffold(true_model: BayesianNetwork, source_var: str, target_var: str)
     return scaffold
 
 
-def run_markovian_scaffolded_generation(model: ReasoningModel, true_model: BayesianNetwork, queries: list, n_samples=10, start_with_sep=False):
+def run_markovian_scaffolded_generation(model: ReasoningModel, true_model: BayesianNetwork, queries: list, n_samples=10, start_with_sep=False, random_seed=0):
+    """
+    Estimate the probability of each query by sampling values for the scaffold variables one at a time,
+    conditioning only on the previous variable. Each (layer, query, sample) draws from its own random
+    stream, so the estimates don't depend on the order in which the queries are evaluated.
+    """
     layer_estimates = {}
     for readout_layer in range(model.model.config.n_layer + 1):
         this_layer_estimates = []
         for observed_var, observed_val, query_var in queries:
             scaffold = get_scaffold(true_model, observed_var, query_var)
             sample_estimates = []
-            for _ in range(n_samples):
+            for sample_idx in range(n_samples):
+                rng = get_rng(
+                    random_seed, readout_layer, observed_var, observed_val, query_var, sample_idx
+                )
                 if start_with_sep:
                     prompt = f"#\n{observed_var}={observed_val}\n"
                 else:
@@ -29,7 +41,7 @@ def run_markovian_scaffolded_generation(model: ReasoningModel, true_model: Bayes
                     prompt += f"{scaffold_var}="
                     logits = model.read_out_from_layer([prompt], readout_layer)
                     prob_estimate = get_probability_from_logits(logits.squeeze())
-                    next_val = 1 if random() < prob_estimate else 0
+                    next_val = 1 if rng.random() < prob_estimate else 0
                     if start_with_sep:
                         prompt = f"#\n{scaffold_var}={next_val}\n"
                     else:
@@ -47,3 +59,264 @@ def run_markovian_scaffolded_generation(model: ReasoningModel, true_model: Bayes
         ] = this_layer_estimates
 
     return layer_estimates
+
+
+ESTIMATOR_MODES = ("direct_pred", "markovian_scaff_gen", "full_scaff_gen", "free_gen")
+
+
+class ReadoutEngine:
+    """
+    Computes readouts at every layer for the prompts needed by the estimators, sharing work between
+    estimator modes, queries, samples and readout layers. Readout probabilities of fixed-context
+    prompts are memoized by prompt, so each distinct prompt is run through the model once; they
+    should be prefetched together in length-bucketed batches. A prompt that extends an earlier
+    prompt only encodes the new tokens, reusing the earlier prompt's KV cache.
+
+    Padding and batch size change readouts in the last few bits, so to keep results independent of
+    which queries are evaluated together, fixed-context prompts are always prefetched as the same
+    canonical batch and KV states are only shared within a query (see reset_states).
+    """
+    def __init__(self, model: ReasoningModel, max_cached_states=1024):
+        self.model = model
+        self.layers = list(range(model.config.n_layer + 1))
+        self.max_cached_states = max_cached_states
+        self.probs = {}
+        self.states = OrderedDict()
+        # the number of extensions whose prefix was not cached and had to be encoded again
+        self.n_prefix_misses = 0
+
+    def prefetch(self, prompts):
+        """
+        Read out every prompt that hasn't been seen yet in batches
+        """
+        missing = list(dict.fromkeys(p for p in prompts if p not in self.probs))
+        if len(missing) == 0:
+            return
+        logits = self.model.read_out_bucketed(missing, self.layers)
+        for i, prompt in enumerate(missing):
+            self.probs[prompt] = np.array(
+                [get_probability_from_logits(logits[layer][i]) for layer in self.layers]
+            )
+
+    def reset_states(self):
+        """
+        Forget every cached KV state, e.g. before moving on to the next query
+        """
+        self.states.clear()
+
+    def get_probs(self, prompt):
+        """
+        Get the probability that the next token is a 1 at every layer
+        """
+        self.prefetch([prompt])
+        return self.probs[prompt]
+
+    def extend(self, prefix, continuation):
+        """
+        Get the next-token logits at every layer for the text prefix + continuation (see
+        extend_tokens). The tokenizer is byte-level without merges, so for plain text the tokens of
+        prefix + continuation are the prefix tokens followed by the continuation tokens.
+        """
+        return self.extend_tokens(self.encode(prefix), self.encode(continuation))
+
+    def encode(self, text):
+        return tuple(self.model.tokenizer(text)["input_ids"]) if text != "" else ()
+
+    def extend_tokens(self, prefix_ids, new_ids):
+        """
+        Get the next-token logits at every layer for the token ids prefix_ids + new_ids. If the prefix
+        was extended earlier, only the new tokens are encoded, starting from the prefix's KV cache.
+        """
+        token_ids = prefix_ids + new_ids
+        if token_ids in self.states:
+            self.states.move_to_end(token_ids)
+            return self.states[token_ids][1]
+
+        past_key_values = None
+        input_ids = token_ids
+        if len(prefix_ids) > 0 and prefix_ids not in self.states:
+            self.n_prefix_misses += 1
+        if prefix_ids in self.states:
+            past_key_values = self.states[prefix_ids][0]
+            input_ids = new_ids
+            # cache objects (unlike legacy tuples) are extended in place, so they can't be shared
+            if not isinstance(past_key_values, tuple):
+                past_key_values = copy.deepcopy(past_key_values)
+
+        transformer = self.model.model.transformer
+        with torch.no_grad():
+            output = transformer(
+                input_ids=torch.tensor([input_ids], device=self.model.device),
+                past_key_values=past_key_values,
+                use_cache=True,
+                output_hidden_states=True,
+            )
+            # the last hidden state already has the final layer norm applied
+            hidden_states = torch.stack([h[0, -1, :] for h in output.hidden_states])
+            logits = self.model.model.lm_head(hidden_states)
+
+        self.states[token_ids] = (output.past_key_values, logits)
+        if len(self.states) > self.max_cached_states:
+            self.states.popitem(last=False)
+
+        return logits
+
+
+def _markovian_prompt(var, val, next_var, start_with_sep):
+    prefix = "#\n" if start_with_sep else ""
+    return f"{prefix}{var}={val}\n{next_var}="
+
+
+def _run_direct_prediction(engine, queries, start_with_sep):
+    estimates = {layer: [] for layer in engine.layers}
+    for observed_var, observed_val, query_var in queries:
+        probs = engine.get_probs(_markovian_prompt(observed_var, observed_val, query_var, start_with_sep))
+        for layer in engine.layers:
+            estimates[layer].append(probs[layer])
+    return estimates
+
+
+def _run_markovian(engine, true_model, queries, n_samples, start_with_sep, random_seed):
+    estimates = {layer: [] for layer in engine.layers}
+    for layer in engine.layers:
+        for observed_var, observed_val, query_var in queries:
+            scaffold = get_scaffold(true_model, observed_var, query_var)
+            sample_estimates = []
+            for sample_idx in range(n_samples):
+                # use the same random streams as run_markovian_scaffolded_generation
+                rng = get_rng(random_seed, layer, observed_var, observed_val, query_var, sample_idx)
+                var, val = observed_var, observed_val
+                for scaffold_var in scaffold:
+                    prompt = _markovian_prompt(var, val, scaffold_var, start_with_sep)
+                    prob_estimate = engine.get_probs(prompt)[layer]
+                    var, val = scaffold_var, 1 if rng.random() < prob_estimate else 0
+                prompt = _markovian_prompt(var, val, query_var, start_with_sep)
+                sample_estimates.append(engine.get_probs(prompt)[layer])
+            estimates[layer].append(sum(sample_estimates) / len(sample_estimates))
+    return estimates
+
+
+def _run_full_context(engine, true_model, queries, n_samples, start_with_sep, random_seed):
+    estimates = {layer: [] for layer in engine.layers}
+    for observed_var, observed_val, query_var in queries:
+        engine.reset_states()
+        scaffold = get_scaffold(true_model, observed_var, query_var)
+        for layer in engine.layers:
+            sample_estimates = []
+            for sample_idx in range(n_samples):
+                rng = get_rng(
+                    random_seed, "full_scaff_gen", layer, observed_var, observed_val, query_var, sample_idx
+                )
+                prompt = ("#\n" if start_with_sep else "") + f"{observed_var}={observed_val}\n"
+                engine.extend("", prompt)
+                for scaffold_var in scaffold:
+                    step_prompt = prompt + f"{scaffold_var}="
+                    logits = engine.extend(prompt, f"{scaffold_var}=")
+                    prob_estimate = get_probability_from_logits(logits[layer])
+                    next_val = 1 if rng.random() < prob_estimate else 0
+                    # extend the cache with the sampled value, so the next step only encodes new tokens
+                    engine.extend(step_prompt, f"{next_val}\n")
+                    prompt = step_prompt + f"{next_val}\n"
+                logits = engine.extend(prompt, f"{query_var}=")
+                sample_estimates.append(get_probability_from_logits(logits[layer]))
+            estimates[layer].append(sum(sample_estimates) / len(sample_estimates))
+    return estimates
+
+
+def _run_free_generation(engine, queries, n_samples, start_with_sep, random_seed, max_new_tokens):
+    estimates = {layer: [] for layer in engine.layers}
+    for observed_var, observed_val, query_var in queries:
+        engine.reset_states()
+        # generated tokens are kept as ids, since not every byte token decodes to valid text
+        stop_ids = engine.encode(f"\n{query_var}=")
+        newline_ids = engine.encode("\n")
+        for layer in engine.layers:
+            sample_estimates = []
+            for sample_idx in range(n_samples):
+                rng = get_rng(
+                    random_seed, "free_gen", layer, observed_var, observed_val, query_var, sample_idx
+                )
+                prompt = ("#\n" if start_with_sep else "") + f"{observed_var}={observed_val}\n"
+                prompt_ids = engine.encode(prompt)
+                logits = engine.extend_tokens((), prompt_ids)
+                # let the model generate until it produces the query variable
+                for _ in range(max_new_tokens):
+                    if prompt_ids[-len(stop_ids):] == stop_ids:
+                        break
+                    probs = F.softmax(logits[layer].double(), dim=0).cpu().numpy()
+                    token = int(min(np.searchsorted(np.cumsum(probs), rng.random()), len(probs) - 1))
+                    logits = engine.extend_tokens(prompt_ids, (token,))
+                    prompt_ids += (token,)
+                # ask about the query variable directly if the model never got there
+                if prompt_ids[-len(stop_ids):] != stop_ids:
+                    at_line_start = prompt_ids[-len(newline_ids):] == newline_ids
+                    forced_ids = engine.encode(("" if at_line_start else "\n") + f"{query_var}=")
+                    logits = engine.extend_tokens(prompt_ids, forced_ids)
+                sample_estimates.append(get_probability_from_logits(logits[layer]))
+            estimates[layer].append(sum(sample_estimates) / len(sample_estimates))
+    return estimates
+
+
+def run_estimators(
+    model: ReasoningModel,
+    true_model: BayesianNetwork,
+    queries: list,
+    modes=ESTIMATOR_MODES,
+    n_samples=10,
+    start_with_sep=False,
+    random_seed=0,
+    max_new_tokens=32,
+    engine=None,
+):
+    """
+    Estimate the probability of each query at every readout layer with several estimators, sharing
+    forward passes between them. Pass the same engine to calls for different queries of the same
+    model (e.g. chunks of an evaluation) to read the fixed-context prompts out only once.
+    - direct_pred reads the query probability straight out after the observation
+    - markovian_scaff_gen samples the scaffold variables one at a time, conditioning only on the
+      previous variable (as in run_markovian_scaffolded_generation)
+    - full_scaff_gen samples the scaffold variables while keeping the whole growing prompt in context
+    - free_gen lets the model generate freely until it produces the query variable
+    """
+    if engine is None:
+        engine = ReadoutEngine(model)
+
+    # batch every fixed-context prompt the graph allows up front. The Markovian prompts are the
+    # direct prompts of adjacent variables, and the batch doesn't depend on the queries, so each
+    # readout is bit-identical however the queries are split up.
+    if "direct_pred" in modes or "markovian_scaff_gen" in modes:
+        engine.prefetch(
+            [
+                _markovian_prompt(var, val, next_var, start_with_sep)
+                for var in true_model.nodes
+                for next_var in true_model.nodes
+                if var != next_var
+                for val in (0, 1)
+            ]
+        )
+
+    mode_estimates = {}
+    for mode in modes:
+        if mode == "direct_pred":
+            mode_estimates[mode] = _run_direct_prediction(engine, queries, start_with_sep)
+        elif mode == "markovian_scaff_gen":
+            mode_estimates[mode] = _run_markovian(
+                engine, true_model, queries, n_samples, start_with_sep, random_seed
+            )
+        elif mode == "full_scaff_gen":
+            mode_estimates[mode] = _run_full_context(
+                engine, true_model, queries, n_samples, start_with_sep, random_seed
+            )
+        elif mode == "free_gen":
+            mode_estimates[mode] = _run_free_generation(
+                engine, queries, n_samples, start_with_sep, random_seed, max_new_tokens
+            )
+        else:
+            raise ValueError(f"Unknown estimator mode: {mode}")
+
+    layer_estimates = {}
+    for mode, estimates in mode_estimates.items():
+        for layer, this_layer_estimates in estimates.items():
+            layer_estimates[f"{mode}_layer_{layer}"] = [float(e) for e in this_layer_estimates]
+
+    return layer_estimates
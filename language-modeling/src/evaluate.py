@@ -1,26 +1,32 @@
 """
 Evaluate a trained model on a range of queries
 """
-from src.reasoning_model import ReasoningModel
-from pgmpy.readwrite import XMLBIFReader
-from pgmpy.inference import VariableElimination
-import pandas as pd
+import os
+import json
 from pyprojroot import here
 from itertools import product
-from src.utils import distance_in_graph
-from src.estimator import run_markovian_scaffolded_generation
+from src.utils import distance_in_graph, get_probability_from_logits, derive_seed
+from src.cache import EvaluationCache, hash_code, hash_config, hash_directory
+
 
 def run_evaluation(args):
+    from src.reasoning_model import ReasoningModel
+    from src.estimator import run_estimators, get_scaffold, ReadoutEngine
+    from pgmpy.readwrite import XMLBIFReader
+    from pgmpy.inference import VariableElimination
+    import pandas as pd
+
     # get the variable names
     reader = XMLBIFReader(here(args["true_model_path"]))
     true_model = reader.get_model()
 
-    # get the trained model
-    model = ReasoningModel(
-        pretrained_name=args["model_name"],
-    )
-
     start_with_sep = args["start_with_sep"]
+    modes = args.get("estimators", ("markovian_scaff_gen",))
+    estimator_args = {
+        "n_samples": args.get("n_samples", 10),
+        "start_with_sep": start_with_sep,
+        "random_seed": derive_seed(args.get("random_seed", 0), args["model_name"]),
+    }
 
     ve = VariableElimination(true_model)
     true_conditional_probs = []
@@ -41,21 +47,251 @@ def run_evaluation(args):
             observed_vals.append(observed_val)
             query_vars.append(query_var)
             distances.append(distance_in_graph(true_model, observed_var, query_var))
-
-    estimates = run_markovian_scaffolded_generation(
-        model, true_model, list(zip(observed_vars, observed_vals, query_vars)), start_with_sep=start_with_sep
-    )
-
-
-    df_results = pd.DataFrame(
+    queries = list(zip(observed_vars, observed_vals, query_vars))
+    df_queries = pd.DataFrame(
         {
             "observed_var": observed_vars,
             "observed_val": observed_vals,
             "query_var": query_vars,
             "distance": distances,
             "true_prob": true_conditional_probs,
-            **estimates
         }
     )
-    
+
+    if "cache_path" in args or "checkpoint_dir" in args:
+        model_hash = hash_directory(here(os.environ["MODELS_DIR"]) / args["model_name"])
+
+    cache = None
+    if "cache_path" in args:
+        cache = EvaluationCache(here(args["cache_path"]), args.get("cache_max_entries", 100_000))
+        base_key = {
+            "model": model_hash,
+            "code": hash_code(),
+            "quantize": args.get("quantize", False),
+            **estimator_args,
+        }
+
+    model = None
+    engine = None
+
+    def estimate_chunk(chunk_queries):
+        """
+        Get the estimates for a chunk of queries, from the cache where possible
+        """
+        nonlocal model, engine
+
+        # look up the estimates that have already been computed for these inputs
+        cached_estimates = {}
+        if cache is not None:
+            cell_keys = {
+                (mode, query): hash_config(
+                    {
+                        **base_key,
+                        "mode": mode,
+                        "query": query,
+                        "scaffold": get_scaffold(true_model, query[0], query[2]),
+                    }
+                )
+                for mode in modes
+                for query in chunk_queries
+            }
+            cached_values = cache.get_many(cell_keys.values())
+            cached_estimates = {
+                cell: cached_values[key] for cell, key in cell_keys.items() if key in cached_values
+            }
+
+        # only load the model and run the estimators for queries with missing estimates
+        missing_queries = [
+            query
+            for query in chunk_queries
+            if any((mode, query) not in cached_estimates for mode in modes)
+        ]
+        if len(missing_queries) > 0:
+            if model is None:
+                model = ReasoningModel(
+                    pretrained_name=args["model_name"],
+                    quantize=args.get("quantize", False),
+                )
+                # shared by every chunk, so the fixed-context prompts are read out once per model
+                engine = ReadoutEngine(model)
+            new_estimates = run_estimators(
+                model, true_model, missing_queries, modes=modes, engine=engine, **estimator_args
+            )
+            n_layers = model.config.n_layer + 1
+            for mode in modes:
+                for i, query in enumerate(missing_queries):
+                    cached_estimates[(mode, query)] = [
+                        new_estimates[f"{mode}_layer_{layer}"][i] for layer in range(n_layers)
+                    ]
+            if cache is not None:
+                cache.put_many(
+                    {
+                        cell_keys[(mode, query)]: cached_estimates[(mode, query)]
+                        for mode in modes
+                        for query in missing_queries
+                    }
+                )
+
+        estimates = {}
+        for mode in modes:
+            n_layers = len(cached_estimates[(mode, chunk_queries[0])])
+            for layer in range(n_layers):
+                estimates[f"{mode}_layer_{layer}"] = [
+                    cached_estimates[(mode, query)][layer] for query in chunk_queries
+                ]
+        return estimates
+
+    if "checkpoint_dir" in args:
+        # flush the results of each chunk of queries to disk as soon as it is done
+        checkpoint_dir = here(args["checkpoint_dir"])
+        chunk_size = args.get("checkpoint_chunk_size", 8)
+        checkpoint_config = {
+            **args,
+            "model_hash": model_hash,
+            "code_hash": hash_code(),
+            "n_chunks": -(-len(queries) // chunk_size),
+        }
+        chunk_frames = []
+        for chunk_idx, start in enumerate(range(0, len(queries), chunk_size)):
+            chunk_frames.append(
+                run_checkpointed_chunk(
+                    checkpoint_dir,
+                    chunk_idx,
+                    lambda: df_queries.iloc[start:start + chunk_size].assign(
+                        **estimate_chunk(queries[start:start + chunk_size])
+                    ),
+                    config=checkpoint_config,
+                )
+            )
+        df_results = pd.concat(chunk_frames, ignore_index=True)
+    else:
+        df_results = df_queries.assign(**estimate_chunk(queries))
+
+    if cache is not None:
+        cache.close()
+
     return df_results
+
+
+def _write_atomically(path, write):
+    """
+    Write a file by writing to a temporary file and renaming it, so readers never see partial files
+    """
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _read_progress(checkpoint_dir):
+    progress_path = os.path.join(checkpoint_dir, "progress.json")
+    if not os.path.exists(progress_path):
+        return None
+    with open(progress_path) as f:
+        return json.load(f)
+
+
+def _write_progress(checkpoint_dir, progress):
+    def write(path):
+        with open(path, "w") as f:
+            json.dump(progress, f)
+
+    _write_atomically(os.path.join(checkpoint_dir, "progress.json"), write)
+
+
+def run_checkpointed_chunk(checkpoint_dir, chunk_idx, compute_chunk, config):
+    """
+    Compute one chunk of an evaluation, or read it back if a previous run already completed it.
+    Completed chunks are written to their own CSV and then recorded in progress.json, both atomically.
+    Progress recorded for a different config (including a different version of the code) is
+    discarded.
+    """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    config_hash = hash_config(config)
+    progress = _read_progress(checkpoint_dir)
+    if progress is None or progress["config_hash"] != config_hash:
+        progress = {"config_hash": config_hash, "n_chunks": config["n_chunks"], "completed": []}
+        # so that the chunks of the previous config are no longer reported as progress
+        _write_progress(checkpoint_dir, progress)
+
+    chunk_path = os.path.join(checkpoint_dir, f"chunk-{chunk_idx:05d}.csv")
+    if chunk_idx in progress["completed"]:
+        import pandas as pd
+
+        return pd.read_csv(chunk_path, float_precision="round_trip")
+
+    df_chunk = compute_chunk()
+    _write_atomically(chunk_path, lambda path: df_chunk.to_csv(path, index=False))
+    progress["completed"] = sorted(set(progress["completed"]) | {chunk_idx})
+    _write_progress(checkpoint_dir, progress)
+    return df_chunk
+
+
+def read_partial_results(checkpoint_dir):
+    """
+    Read the results of the chunks an evaluation has completed so far, e.g. while it is still running.
+    Returns the results and the fraction of chunks that are complete.
+    """
+    import pandas as pd
+
+    progress = _read_progress(here(checkpoint_dir))
+    if progress is None or len(progress["completed"]) == 0:
+        return pd.DataFrame(), 0.0
+    df_results = pd.concat(
+        [
+            pd.read_csv(
+                os.path.join(here(checkpoint_dir), f"chunk-{chunk_idx:05d}.csv"),
+                float_precision="round_trip",
+            )
+            for chunk_idx in progress["completed"]
+        ],
+        ignore_index=True,
+    )
+    return df_results, len(progress["completed"]) / progress["n_chunks"]
+
+
+def run_quantization_parity_check(args):
+    """
+    Compare the per-layer readout probabilities of the int8 quantized model against the fp32 model
+    for every query, using the direct prompt (observed variable followed by the query variable)
+    """
+    from src.reasoning_model import ReasoningModel
+    from pgmpy.readwrite import XMLBIFReader
+    import pandas as pd
+
+    reader = XMLBIFReader(here(args["true_model_path"]))
+    true_model = reader.get_model()
+
+    fp32_model = ReasoningModel(pretrained_name=args["model_name"])
+    int8_model = ReasoningModel(pretrained_name=args["model_name"], quantize=True)
+    prefix = "#\n" if args["start_with_sep"] else ""
+
+    queries, prompts = [], []
+    for observed_var, query_var in product(true_model.nodes, repeat=2):
+        if observed_var == query_var:
+            continue
+        for observed_val in (0, 1):
+            queries.append((observed_var, observed_val, query_var))
+            prompts.append(f"{prefix}{observed_var}={observed_val}\n{query_var}=")
+
+    layers = range(fp32_model.config.n_layer + 1)
+    fp32_logits = fp32_model.read_out_bucketed(prompts, layers)
+    int8_logits = int8_model.read_out_bucketed(prompts, layers)
+
+    rows = []
+    for i, (observed_var, observed_val, query_var) in enumerate(queries):
+        for layer in layers:
+            fp32_prob = get_probability_from_logits(fp32_logits[layer][i])
+            int8_prob = get_probability_from_logits(int8_logits[layer][i])
+            rows.append(
+                {
+                    "observed_var": observed_var,
+                    "observed_val": observed_val,
+                    "query_var": query_var,
+                    "layer": layer,
+                    "fp32_prob": fp32_prob,
+                    "int8_prob": int8_prob,
+                    "abs_diff": abs(fp32_prob - int8_prob),
+                }
+            )
+
+    return pd.DataFrame(rows)
@@ -1,9 +1,37 @@
 import os
-from transformers import GPT2Config, GPT2LMHeadModel, GPT2Tokenizer
+import time
 import torch.nn.functional as F
+from torch import nn
 from pyprojroot import here
 import torch
 import numpy as np
+from src.utils import get_rng, bucket_by_length
+
+
+def conv1d_to_linear(module: nn.Module) -> nn.Module:
+    """
+    Recursively replace GPT-2's Conv1D layers with equivalent nn.Linear layers. Conv1D stores its
+    weight as [in_features, out_features], so the weight is transposed into nn.Linear's layout.
+    Dynamic quantization only recognizes nn.Linear, so this has to happen before quantizing.
+    """
+    from transformers.pytorch_utils import Conv1D
+
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            in_features, out_features = child.weight.shape
+            linear = nn.Linear(in_features, out_features)
+            linear.weight.data = child.weight.data.t().contiguous()
+            linear.bias.data = child.bias.data.clone()
+            setattr(module, name, linear)
+        else:
+            conv1d_to_linear(child)
+    return module
+
+
+class _StopForward(Exception):
+    """
+    Raised by a forward hook to end the forward pass once all requested hidden states are captured
+    """
 
 
 class ReasoningModel:
@@ -21,7 +49,10 @@ class ReasoningModel:
         scheduler_args={},
         pretrained_name=None,
         training_dataset_type="single-sample",
+        quantize=False,
+        random_seed=0,
     ):
+        from transformers import GPT2Config, GPT2LMHeadModel, GPT2Tokenizer
 
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         if pretrained_name is None:
@@ -35,6 +66,10 @@ class ReasoningModel:
             self.model = GPT2LMHeadModel.from_pretrained(model_path).to(self.device)
             self.config = self.model.config
             self.tokenizer = GPT2Tokenizer.from_pretrained(model_path)
+        if quantize:
+            if pretrained_name is None:
+                raise ValueError("Quantization is only supported for pretrained models")
+            self.quantize()
         if optimizer is not None:
             self.optimizer = optimizer(self.model.parameters(), **optimizer_args)
 
@@ -44,16 +79,61 @@ class ReasoningModel:
             self.scheduler = None
 
         self.training_dataset_type = training_dataset_type
+        self.random_seed = random_seed
+        # the stream used for batches drawn without an explicit generator, so each call gets a new batch
+        self.rng = get_rng(random_seed, "training-batch")
+        self.accuracy_history = []
         self.tokenizer.pad_token_id = self.tokenizer.eos_token_id
 
+    def quantize(self):
+        """
+        Convert the language model to int8 for inference by dynamically quantizing all of its linear
+        layers, including GPT-2's Conv1D layers and the language modeling head. Quantized models
+        run on the CPU.
+        """
+        # torch.ao.quantization.quantize_dynamic is deprecated and due to be removed from torch, so
+        # this uses its replacement, torchao's quantize_ with int8 dynamic activations and weights
+        from torchao.quantization import quantize_, Int8DynamicActivationInt8WeightConfig
+
+        self.device = "cpu"
+        self.model = conv1d_to_linear(self.model.to(self.device).eval())
+        quantize_(
+            self.model,
+            Int8DynamicActivationInt8WeightConfig(),
+            filter_fn=lambda module, fqn: isinstance(module, nn.Linear),
+        )
+
+    def encode_prompts(self, prompts):
+        """
+        Tokenize prompts of possibly different lengths. Prompts are padded on the left, so the last
+        position of every row holds the last token of its prompt, and the attention mask and position
+        ids make each row behave as if it had been run on its own.
+        """
+        token_lists = self.tokenizer(list(prompts))["input_ids"]
+        max_length = max(len(tokens) for tokens in token_lists)
+        input_ids = torch.full(
+            (len(token_lists), max_length), self.tokenizer.pad_token_id, dtype=torch.long
+        )
+        attention_mask = torch.zeros_like(input_ids)
+        for i, tokens in enumerate(token_lists):
+            input_ids[i, max_length - len(tokens):] = torch.tensor(tokens)
+            attention_mask[i, max_length - len(tokens):] = 1
+        position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)
+
+        return (
+            input_ids.to(self.device),
+            attention_mask.to(self.device),
+            position_ids.to(self.device),
+        )
+
     def get_next_token_logits(self, prompts):
         """
         Get logits for the next token in the sequence
         """
-        tokens = self.tokenizer(prompts, padding=True, return_tensors="pt")[
-            "input_ids"
-        ].to(self.device)
-        outputs = self.model(tokens)
+        input_ids, attention_mask, position_ids = self.encode_prompts(prompts)
+        outputs = self.model(
+            input_ids, attention_mask=attention_mask, position_ids=position_ids
+        )
         output_logits = outputs.logits[:, -1, :].squeeze()
 
         return output_logits
@@ -63,17 +143,80 @@ class ReasoningModel:
         Read out logits by applying the model's language modeling head to the last hidden state of a
         particular layer.
         """
-        # tokenize the sequence
-        input_ids = self.tokenizer(sequences, return_tensors="pt")["input_ids"].to(
-            self.device
-        )
-        # get the hidden states
-        model_output = self.model(input_ids=input_ids, output_hidden_states=True)
-        chosen_hidden_state = model_output.hidden_states[layer_num][:, -1, :]
-        logits = self.model.lm_head(chosen_hidden_state)
+        return self.read_out_from_layers(sequences, [layer_num])[layer_num]
+
+    def read_out_from_layers(self, sequences, layer_nums):
+        """
+        Read out logits from several layers with a single forward pass. Forward hooks keep only the
+        last-position hidden state of each requested layer, and the forward pass stops after the
+        deepest requested block. The final layer norm is applied to the last layer's readout only,
+        matching the hidden states returned by the model with output_hidden_states=True.
+        """
+        input_ids, attention_mask, position_ids = self.encode_prompts(sequences)
+
+        layer_nums = sorted(set(layer_nums))
+        deepest_layer = layer_nums[-1]
+        transformer = self.model.transformer
+        hidden_states = {}
+
+        def capture_hidden_state(layer_num):
+            def hook(module, inputs, output):
+                hidden_state = output[0] if isinstance(output, tuple) else output
+                # a copy, so the full [batch, seq, hidden] output isn't kept alive until the readout
+                hidden_states[layer_num] = hidden_state[:, -1, :].clone()
+                if layer_num == deepest_layer:
+                    raise _StopForward
+
+            return hook
+
+        # hidden state 0 is the embedding output and hidden state i is the output of block i - 1
+        handles = [
+            (transformer.drop if layer_num == 0 else transformer.h[layer_num - 1])
+            .register_forward_hook(capture_hidden_state(layer_num))
+            for layer_num in layer_nums
+        ]
+        try:
+            with torch.no_grad():
+                transformer(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    position_ids=position_ids,
+                    use_cache=False,
+                )
+        except _StopForward:
+            pass
+        finally:
+            for handle in handles:
+                handle.remove()
+
+        logits = {}
+        with torch.no_grad():
+            for layer_num in layer_nums:
+                hidden_state = hidden_states[layer_num]
+                if layer_num == self.config.n_layer:
+                    hidden_state = transformer.ln_f(hidden_state)
+                logits[layer_num] = self.model.lm_head(hidden_state)
 
         return logits
 
+    def read_out_bucketed(self, sequences, layer_nums, max_batch_size=256):
+        """
+        Read out logits from several layers for many prompts of different lengths. Prompts are
+        bucketed by token length so that each forward pass needs as little padding as possible, and
+        the logits for each layer are returned in the original prompt order.
+        """
+        lengths = [len(tokens) for tokens in self.tokenizer(list(sequences))["input_ids"]]
+        logits = {layer_num: [None] * len(sequences) for layer_num in layer_nums}
+        for batch in bucket_by_length(lengths, max_batch_size):
+            batch_logits = self.read_out_from_layers(
+                [sequences[i] for i in batch], layer_nums
+            )
+            for layer_num, layer_logits in batch_logits.items():
+                for i, row_logits in zip(batch, layer_logits):
+                    logits[layer_num][i] = row_logits
+
+        return {layer_num: torch.stack(rows) for layer_num, rows in logits.items()}
+
     def get_accuracy(self, dataset):
         """
         Get the accuracy in predicting the last token in each sample of the dataset
@@ -95,21 +238,24 @@ class ReasoningModel:
         label_probs = probs[torch.arange(len(label_tokens)), label_tokens]
         return torch.mean(label_probs).item()
 
-    def get_training_batch(self, all_samples, batch_size=16, sample_length=16):
+    def get_training_batch(self, all_samples, batch_size=16, sample_length=16, rng=None):
         """
         Get a batch of the training dataset
         """
         if self.training_dataset_type == "single-sample":
             return all_samples
-        
+
+        if rng is None:
+            rng = self.rng
+
         # generate a random batch of samples
-        chosen_samples = np.random.choice(all_samples, (batch_size, sample_length), replace=True)
+        chosen_samples = rng.choice(all_samples, (batch_size, sample_length), replace=True)
 
         # add a separator depending on the training dataset type
         if self.training_dataset_type == "batch-no-separator":
             training_strings = ["\n".join(sample) for sample in chosen_samples]
             training_strings = [
-                s[4:] if np.random.random() <= 0.5 else s[:-4] for s in training_strings
+                s[4:] if rng.random() <= 0.5 else s[:-4] for s in training_strings
             ]
         elif self.training_dataset_type == "batch-with-separator":
             training_strings = [
@@ -118,27 +264,84 @@ class ReasoningModel:
 
         return training_strings
 
-    def train_to_criterion(self, train_dataset, threshold: float):
+    def get_training_batch_from_corpus(self, corpus, batch_size=16, sample_length=16, rng=None):
         """
-        Train the language model to criterion (defined as the average accuracy exceeding a threshold)
+        Get a batch of token ids and labels from a pre-tokenized corpus (see src/corpus.py), assembled
+        the same way as get_training_batch assembles strings. Rows of different lengths are padded on
+        the right and the padding is excluded from the loss.
         """
-        last_accuracy = 0
-        accuracy = 0
-        iteration = 0
+        if rng is None:
+            rng = self.rng
+
+        newline = self.tokenizer.encode("\n")
+        rows = []
+        for _ in range(batch_size):
+            samples = corpus.sample(sample_length, rng)
+            if self.training_dataset_type == "batch-no-separator":
+                tokens = np.concatenate([t for sample in samples for t in (newline, sample)][1:])
+                tokens = tokens[4:] if rng.random() <= 0.5 else tokens[:-4]
+            elif self.training_dataset_type == "batch-with-separator":
+                separator = self.tokenizer.encode("#\n")
+                tokens = np.concatenate(
+                    [t for sample in samples for t in (newline, separator, sample)][1:]
+                )
+            else:
+                raise ValueError(
+                    f"Training from a corpus is not supported for {self.training_dataset_type}"
+                )
+            rows.append(torch.tensor(tokens.astype(np.int64)))
+
+        input_ids = torch.nn.utils.rnn.pad_sequence(
+            rows, batch_first=True, padding_value=self.tokenizer.pad_token_id
+        )
+        labels = torch.nn.utils.rnn.pad_sequence(rows, batch_first=True, padding_value=-100)
+
+        return input_ids.to(self.device), labels.to(self.device)
+
+    def train_to_criterion(
+        self,
+        train_dataset,
+        threshold: float,
+        training_corpus=None,
+        max_iterations=None,
+        max_seconds=None,
+    ):
+        """
+        Train the language model to criterion (defined as the average accuracy exceeding a threshold).
+        If a training corpus is given, batches are drawn from it, and the accuracy is still measured on
+        the training dataset.
+
+        Training stops early once the model has been trained for max_iterations iterations in total or
+        this call has taken max_seconds. Calling this again continues training where it stopped.
+        Returns whether the model reached criterion.
+        """
+        accuracy = self.accuracy_history[-1] if len(self.accuracy_history) > 0 else 0
+        last_accuracy = self.accuracy_history[-2] if len(self.accuracy_history) > 1 else 0
+        start_time = time.time()
         # keep training until we hit the threshold
         while accuracy < threshold or last_accuracy < threshold:
+            iteration = len(self.accuracy_history)
+            if max_iterations is not None and iteration >= max_iterations:
+                return False
+            if max_seconds is not None and time.time() - start_time >= max_seconds:
+                return False
 
             # get the training batch
-            batch = self.get_training_batch(train_dataset)
+            rng = get_rng(self.random_seed, "training-batch", iteration)
+            if training_corpus is None:
+                batch = self.get_training_batch(train_dataset, rng=rng)
 
-            # encode the dataset
-            input_ids = self.tokenizer(batch, return_tensors="pt")["input_ids"].to(
-                self.device
-            )
+                # encode the dataset
+                input_ids = self.tokenizer(batch, return_tensors="pt")["input_ids"].to(
+                    self.device
+                )
+                labels = input_ids
+            else:
+                input_ids, labels = self.get_training_batch_from_corpus(training_corpus, rng=rng)
 
             # zero the gradient and make predictions
             self.optimizer.zero_grad()
-            output = self.model(input_ids, labels=input_ids)
+            output = self.model(input_ids, labels=labels)
             loss = output.loss
 
             # backpropagate the loss
@@ -154,10 +357,12 @@ class ReasoningModel:
             # compute the accuracy
             last_accuracy = accuracy
             accuracy = self.get_accuracy(train_dataset)
+            self.accuracy_history.append(accuracy)
             print(
                 f"iteration {iteration}: loss={loss.item():.4f}, accuracy={accuracy:.3f}, lr={learning_rate:.6f}"
             )
-            iteration += 1
+
+        return True
 
     def save(self, model_name):
         """
@@ -0,0 +1,92 @@
+"""
+Search for training hyperparameters that reach criterion quickly, using successive halving
+"""
+import math
+import time
+from src.train import setup_training
+
+
+def _trajectory_score(accuracy_history, window=5):
+    """
+    Score a partially trained config by its recent accuracy, so a single lucky batch doesn't count
+    """
+    recent = accuracy_history[-window:]
+    return sum(recent) / len(recent) if len(recent) > 0 else 0
+
+
+def successive_halving(configs, min_iterations=100, max_iterations=10_000, eta=2, max_seconds=None):
+    """
+    Train each config to criterion under a growing iteration budget, keeping only the most promising
+    configs after each round. Every config starts with min_iterations iterations. After each round,
+    configs that reached criterion are finished, the best 1 / eta of the others (by their recent
+    accuracy) continue training with eta times the budget, and the rest are stopped. No config
+    trains for more than max_iterations iterations or max_seconds seconds in total.
+
+    Returns one result per config with the iterations and wall-clock time it used and whether it
+    reached criterion, sorted so the configs that reached criterion fastest come first.
+    """
+    results = [
+        {
+            "config_idx": i,
+            "reached_criterion": False,
+            "iterations": 0,
+            "seconds": 0.0,
+            "final_accuracy": 0.0,
+            "stopped_at_round": None,
+        }
+        for i in range(len(configs))
+    ]
+    active = {}
+    for i, config in enumerate(configs):
+        start_time = time.time()
+        active[i] = setup_training(config)
+        results[i]["seconds"] += time.time() - start_time
+
+    budget = min_iterations
+    round_idx = 0
+    while len(active) > 0:
+        budget = min(budget, max_iterations)
+        for i, (model, training_samples, training_corpus) in active.items():
+            time_left = None if max_seconds is None else max_seconds - results[i]["seconds"]
+            start_time = time.time()
+            reached_criterion = model.train_to_criterion(
+                training_samples,
+                threshold=configs[i]["criterion_threshold"],
+                training_corpus=training_corpus,
+                max_iterations=budget,
+                max_seconds=time_left,
+            )
+            results[i]["seconds"] += time.time() - start_time
+            results[i]["iterations"] = len(model.accuracy_history)
+            results[i]["final_accuracy"] = _trajectory_score(model.accuracy_history, window=1)
+            results[i]["reached_criterion"] = reached_criterion
+
+        # finished configs leave the pool, either by reaching criterion or by using up their budget
+        for i in list(active):
+            out_of_time = max_seconds is not None and results[i]["seconds"] >= max_seconds
+            if results[i]["reached_criterion"] or budget >= max_iterations or out_of_time:
+                results[i]["stopped_at_round"] = round_idx
+                del active[i]
+
+        # keep the most promising of the remaining configs
+        ranked = sorted(
+            active, key=lambda i: _trajectory_score(active[i][0].accuracy_history), reverse=True
+        )
+        for i in ranked[math.ceil(len(ranked) / eta):]:
+            results[i]["stopped_at_round"] = round_idx
+            del active[i]
+
+        print(
+            f"round {round_idx}: budget={budget}, "
+            f"{sum(r['reached_criterion'] for r in results)} configs reached criterion, "
+            f"{len(active)} continue"
+        )
+        budget *= eta
+        round_idx += 1
+
+    def rank(result):
+        if result["reached_criterion"]:
+            return (0, result["iterations"])
+        return (1, -result["final_accuracy"])
+
+    return sorted(results, key=rank)
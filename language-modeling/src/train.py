@@ -1,24 +1,18 @@
-from src.reasoning_model import ReasoningModel
-from pgmpy.readwrite import XMLBIFReader
-from pgmpy.inference import VariableElimination
 from pyprojroot import here
-from transformers import set_seed
-import numpy as np
+from src.utils import get_rng
 
 
-def compile_training_set(true_model_path):
+def compile_training_set(true_model_path, random_seed=0):
+    from pgmpy.readwrite import XMLBIFReader
+    from pgmpy.inference import VariableElimination
+    from src.corpus import get_adjacent_pairs
+
     # read the true model
     reader = XMLBIFReader(here(true_model_path))
     model = reader.get_model()
 
     # get all adjacent variable pairs
-    pairs = []
-    for node in model.nodes():
-        if len(model.get_parents(node)) == 0:
-            continue
-        parent = model.get_parents(node)[0]
-        pairs.append((parent, node))
-        pairs.append((node, parent))
+    pairs = get_adjacent_pairs(model)
 
     # get all possible combinations of values for each pair
     training_samples = []
@@ -31,7 +25,8 @@ def compile_training_set(true_model_path):
                 show_progress=False,
             ).values[1]
 
-            query_val = 1 if np.random.random() < conditional_prob else 0
+            rng = get_rng(random_seed, "training-set", observed_var, query_var, observed_val)
+            query_val = 1 if rng.random() < conditional_prob else 0
             training_samples.append(
                 f"{observed_var}={observed_val}\n{query_var}={query_val}"
             )
@@ -39,7 +34,13 @@ def compile_training_set(true_model_path):
     return training_samples
 
 
-def train_model(args):
+def setup_training(args):
+    """
+    Initialize a model and its training data from the training arguments
+    """
+    from transformers import set_seed
+    from src.reasoning_model import ReasoningModel
+    from src.corpus import ShardedCorpus
 
     # set the random seed
     random_seed = args["random_seed"] if "random_seed" in args else 0
@@ -53,13 +54,35 @@ def train_model(args):
         scheduler=args["scheduler"],
         scheduler_args=args["scheduler_args"],
         training_dataset_type=args["training_dataset_type"],
+        random_seed=random_seed,
+    )
+
+    # create the training set
+    training_samples = compile_training_set(args["true_model_path"], random_seed=random_seed)
+    training_corpus = (
+        ShardedCorpus(here(args["training_corpus_dir"]))
+        if "training_corpus_dir" in args
+        else None
     )
 
-    # create the training set and do the training
-    training_samples = compile_training_set(args["true_model_path"])
-    model.train_to_criterion(
-        training_samples, threshold=args["criterion_threshold"]
+    return model, training_samples, training_corpus
+
+
+def train_model(args):
+    model, training_samples, training_corpus = setup_training(args)
+
+    # do the training
+    reached_criterion = model.train_to_criterion(
+        training_samples,
+        threshold=args["criterion_threshold"],
+        training_corpus=training_corpus,
+        max_iterations=args.get("max_iterations"),
+        max_seconds=args.get("max_seconds"),
     )
 
     # save the model
-    model.save(args["model_name"] + "_criterion")
\ No newline at end of file
+    if reached_criterion:
+        model.save(args["model_name"] + "_criterion")
+    else:
+        print(f"training budget ran out before reaching criterion: {args['model_name']}")
+        model.save(args["model_name"] + "_incomplete")
\ No newline at end of file
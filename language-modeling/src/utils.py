@@ -1,7 +1,14 @@
-import torch
-import torch.nn.functional as F
-import networkx as nx
-from pgmpy.models import BayesianNetwork
+from __future__ import annotations
+import hashlib
+import json
+from typing import TYPE_CHECKING
+import numpy as np
+
+# torch, transformers, networkx and pgmpy are slow to import, so throughout src they are only
+# imported inside the functions that use them
+if TYPE_CHECKING:
+    import torch
+    from pgmpy.models import BayesianNetwork
 ZERO_TOKEN = 15
 ONE_TOKEN = 16
 
@@ -10,10 +17,54 @@ def get_probability_from_logits(logits: torch.Tensor) -> float:
     """
     Turn a dictionary of log probs into a probability estimate
     """
+    import torch
+    import torch.nn.functional as F
+
     log_probs = torch.tensor([logits[ZERO_TOKEN], logits[ONE_TOKEN]])
     probs = F.softmax(log_probs, dim=0)
     return probs[1].item()
 
 
 def distance_in_graph(true_model: BayesianNetwork, var1: str, var2: str):
+    import networkx as nx
+
     return nx.shortest_path_length(true_model.to_undirected(), source=var1, target=var2)
+
+
+def _to_builtin(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"can't derive a seed from a key of type {type(value).__name__}")
+
+
+def derive_seed(root_seed: int, *keys) -> int:
+    """
+    Derive a seed for an independent random stream from a root seed and a tuple of keys (e.g. model,
+    query, and sample index). The same root seed and keys always give the same seed, regardless of
+    the order in which streams are created. Keys are encoded as JSON, with numpy scalars converted to
+    Python values first, so a key read back from numpy or pandas gives the same seed.
+    """
+    spawn_key = tuple(
+        int.from_bytes(
+            hashlib.sha256(json.dumps(key, default=_to_builtin).encode()).digest()[:8], "little"
+        )
+        for key in keys
+    )
+    seed_sequence = np.random.SeedSequence(entropy=root_seed, spawn_key=spawn_key)
+    return int(seed_sequence.generate_state(1, dtype=np.uint64)[0])
+
+
+def get_rng(root_seed: int, *keys) -> np.random.Generator:
+    """
+    Get a random number generator for the stream identified by a root seed and a tuple of keys
+    """
+    return np.random.default_rng(derive_seed(root_seed, *keys))
+
+
+def bucket_by_length(lengths: list, max_batch_size: int) -> list:
+    """
+    Group item indices into batches of items with similar lengths, so that padding within each batch
+    is minimal. Returns a list of batches, each of which is a list of indices.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    return [order[i:i + max_batch_size] for i in range(0, len(order), max_batch_size)]
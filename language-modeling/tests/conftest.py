@@ -0,0 +1,34 @@
+import pytest
+from src.reasoning_model import ReasoningModel
+
+
+@pytest.fixture
+def small_config():
+    """
+    The config of a language model that is small enough to build and run in every test
+    """
+    return {"vocab_size": 257, "n_positions": 512, "n_embd": 32, "n_layer": 2, "n_head": 2}
+
+
+@pytest.fixture
+def tiny_model_dir(tmp_path, monkeypatch, small_config):
+    """
+    Save an untrained small model to a temporary models directory, and return its directory
+    """
+    monkeypatch.setenv("MODELS_DIR", str(tmp_path))
+    ReasoningModel(small_config).save("tiny")
+    return tmp_path / "tiny"
+
+
+@pytest.fixture
+def evaluation_args(tiny_model_dir):
+    """
+    Arguments for a quick evaluation of the tiny model on chain 0
+    """
+    return {
+        "true_model_path": "data/chains/chain_0.xbn",
+        "model_name": tiny_model_dir.name,
+        "start_with_sep": True,
+        "n_samples": 2,
+        "estimators": ["direct_pred", "markovian_scaff_gen"],
+    }
@@ -0,0 +1,40 @@
+import pytest
+import src.estimator
+from src.cache import EvaluationCache, hash_config
+from src.evaluate import run_evaluation
+
+
+def test_evaluation_cache(tmp_path):
+    cache = EvaluationCache(tmp_path / "cache.sqlite", max_entries=3)
+    cache.put_many({"a": [0.1, 0.2], "b": [0.3]})
+    assert cache.get_many(["a", "b", "c"]) == {"a": [0.1, 0.2], "b": [0.3]}
+
+    # "a" was used least recently once "b" is read again, so it is evicted first
+    cache.get_many(["b"])
+    cache.put_many({"c": [0.4]})
+    cache.get_many(["b", "c"])
+    cache.put_many({"d": [0.5]})
+    assert len(cache) == 3
+    assert set(cache.get_many(["a", "b", "c", "d"])) == {"b", "c", "d"}
+
+
+def test_hash_config():
+    assert hash_config({"a": 1, "b": [1, 2]}) == hash_config({"b": [1, 2], "a": 1})
+    assert hash_config({"a": 1}) != hash_config({"a": 2})
+
+
+def test_run_evaluation_uses_cache(tmp_path, monkeypatch, evaluation_args):
+    args = {**evaluation_args, "cache_path": str(tmp_path / "cache.sqlite")}
+    df_results = run_evaluation(args)
+
+    # a second run with the same inputs never runs the estimators
+    def fail(*args, **kwargs):
+        raise AssertionError("estimators should not run when results are cached")
+
+    monkeypatch.setattr(src.estimator, "run_estimators", fail)
+    df_cached = run_evaluation(args)
+    assert df_cached.equals(df_results)
+
+    # changing the estimator config invalidates the cached estimates
+    with pytest.raises(AssertionError):
+        run_evaluation({**args, "n_samples": 3})
@@ -0,0 +1,65 @@
+import numpy as np
+from pgmpy.readwrite import XMLBIFReader
+from pyprojroot import here
+from src.corpus import (
+    ancestral_sample,
+    get_adjacent_pairs,
+    sample_corpus,
+    write_corpus_shards,
+    ShardedCorpus,
+)
+from src.reasoning_model import ReasoningModel
+from src.utils import get_rng
+
+
+def get_chain():
+    # chain 0: B = A, C = B, D = not C, E = D
+    return XMLBIFReader(here("data/chains/chain_0.xbn")).get_model()
+
+
+def test_ancestral_sample():
+    samples = ancestral_sample(get_chain(), 10_000, get_rng(0))
+    assert abs(samples["A"].mean() - 0.5) < 0.02
+    assert (samples["B"] == samples["A"]).all()
+    assert (samples["C"] == samples["B"]).all()
+    assert (samples["D"] == 1 - samples["C"]).all()
+    assert (samples["E"] == samples["D"]).all()
+
+
+def test_sample_corpus_is_reproducible(small_config):
+    tokenizer = ReasoningModel(small_config).tokenizer
+    chunks = list(sample_corpus(get_chain(), tokenizer, 250, chunk_size=100, random_seed=1))
+    assert len(chunks) == 3
+    assert sum(len(rows) for chunk in chunks for rows in chunk) == 250
+
+    chunks_again = list(sample_corpus(get_chain(), tokenizer, 250, chunk_size=100, random_seed=1))
+    for chunk, chunk_again in zip(chunks, chunks_again):
+        for rows, rows_again in zip(chunk, chunk_again):
+            assert (rows == rows_again).all()
+
+
+def test_corpus_shards(tmp_path, small_config):
+    model = ReasoningModel(small_config, training_dataset_type="batch-with-separator")
+    true_model = get_chain()
+    pairs = get_adjacent_pairs(true_model)
+    chunks = sample_corpus(true_model, model.tokenizer, 500, chunk_size=200)
+    write_corpus_shards(chunks, tmp_path)
+
+    corpus = ShardedCorpus(tmp_path)
+    assert len(corpus) == 500
+    for idx in (0, 199, 200, 499):
+        sample = model.tokenizer.decode(corpus[idx])
+        observed, query = sample.split("\n")
+        assert (observed[0], query[0]) in pairs
+        # every adjacent pair in chain 0 is either always equal or always different
+        same = observed[2] == query[2]
+        assert same == (set((observed[0], query[0])) != {"C", "D"})
+
+    input_ids, labels = model.get_training_batch_from_corpus(
+        corpus, batch_size=2, sample_length=3, rng=get_rng(0)
+    )
+    assert input_ids.shape == (2, 2 + 3 * 7 + 2 * 3)
+    assert (labels == input_ids).all()
+    text = model.tokenizer.decode(input_ids[0])
+    assert text.startswith("#\n") and text.count("\n#\n") == 2
+    assert np.isfinite(model.model(input_ids, labels=labels).loss.item())
@@ -0,0 +1,51 @@
+import pytest
+import pandas as pd
+import src.estimator
+import src.evaluate
+from src.evaluate import run_evaluation, read_partial_results
+
+
+def test_run_evaluation_resumes_from_checkpoint(tmp_path, monkeypatch, evaluation_args):
+    args = {
+        **evaluation_args,
+        "checkpoint_dir": str(tmp_path / "checkpoint"),
+        "checkpoint_chunk_size": 8,
+    }
+    df_results = run_evaluation({k: v for k, v in args.items() if k != "checkpoint_dir"})
+
+    # simulate a job that is killed after finishing three chunks
+    run_estimators = src.estimator.run_estimators
+    n_calls = 0
+
+    def killed_after_three_chunks(*args, **kwargs):
+        nonlocal n_calls
+        n_calls += 1
+        if n_calls > 3:
+            raise KeyboardInterrupt
+        return run_estimators(*args, **kwargs)
+
+    monkeypatch.setattr(src.estimator, "run_estimators", killed_after_three_chunks)
+    with pytest.raises(KeyboardInterrupt):
+        run_evaluation(args)
+
+    df_partial, fraction_done = read_partial_results(args["checkpoint_dir"])
+    assert len(df_partial) == 24
+    assert fraction_done == 3 / 5
+
+    # the restarted job only computes the remaining chunks
+    n_calls = 0
+    df_resumed = run_evaluation(args)
+    assert n_calls == 2
+    pd.testing.assert_frame_equal(df_resumed, df_results, check_exact=True)
+
+    # a code change discards the checkpointed chunks as soon as the evaluation restarts
+    def killed_immediately(*args, **kwargs):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(src.evaluate, "hash_code", lambda: "changed")
+    monkeypatch.setattr(src.estimator, "run_estimators", killed_immediately)
+    with pytest.raises(KeyboardInterrupt):
+        run_evaluation(args)
+    df_partial, fraction_done = read_partial_results(args["checkpoint_dir"])
+    assert len(df_partial) == 0
+    assert fraction_done == 0.0
@@ -0,0 +1,106 @@
+import copy
+import torch
+from torch import nn
+from transformers.pytorch_utils import Conv1D
+from src.reasoning_model import ReasoningModel, conv1d_to_linear
+from src.utils import get_probability_from_logits
+
+
+def test_conv1d_to_linear(small_config):
+    torch.manual_seed(0)
+    model = ReasoningModel(small_config).model.eval()
+    converted = conv1d_to_linear(copy.deepcopy(model))
+    assert not any(isinstance(m, Conv1D) for m in converted.modules())
+    assert isinstance(converted.transformer.h[0].attn.c_attn, nn.Linear)
+
+    input_ids = torch.tensor([[0, 1, 2, 3]])
+    with torch.no_grad():
+        expected = model(input_ids).logits
+        actual = converted(input_ids).logits
+    assert torch.allclose(expected, actual, atol=1e-5)
+
+
+def test_quantize(small_config):
+    torch.manual_seed(0)
+    model = ReasoningModel(small_config)
+    prompts = ["#\nA=1\nB="]
+    fp32_probs = [
+        get_probability_from_logits(model.read_out_from_layer(prompts, layer).squeeze())
+        for layer in range(small_config["n_layer"] + 1)
+    ]
+
+    model.quantize()
+    assert model.device == "cpu"
+    assert type(model.model.lm_head.weight) is not nn.Parameter
+    assert type(model.model.transformer.h[0].mlp.c_fc.weight) is not nn.Parameter
+    int8_probs = [
+        get_probability_from_logits(model.read_out_from_layer(prompts, layer).squeeze())
+        for layer in range(small_config["n_layer"] + 1)
+    ]
+    for fp32_prob, int8_prob in zip(fp32_probs, int8_probs):
+        assert abs(fp32_prob - int8_prob) < 0.05
+
+
+def test_read_out_from_layers_matches_hidden_states(small_config):
+    torch.manual_seed(0)
+    model = ReasoningModel(small_config)
+    model.model.eval()
+    prompts = ["#\nA=1\nB=", "#\nC=0\nD="]
+
+    input_ids = model.tokenizer(prompts, return_tensors="pt")["input_ids"]
+    with torch.no_grad():
+        hidden_states = model.model(input_ids, output_hidden_states=True).hidden_states
+
+    all_layers = range(small_config["n_layer"] + 1)
+    readouts = model.read_out_from_layers(prompts, all_layers)
+    for layer in all_layers:
+        with torch.no_grad():
+            expected = model.model.lm_head(hidden_states[layer][:, -1, :])
+        assert torch.allclose(readouts[layer], expected, atol=1e-5)
+        assert torch.allclose(model.read_out_from_layer(prompts, layer), expected, atol=1e-5)
+
+
+def test_read_out_from_layers_keeps_only_last_position(small_config):
+    model = ReasoningModel(small_config)
+    prompts = ["#\nA=1\nB=0\nC=1\nD=", "#\nC=0\nD="]
+    storage_sizes = []
+
+    # the captured hidden states only hold the last position, not the whole sequence
+    model.model.lm_head.register_forward_pre_hook(
+        lambda module, inputs: storage_sizes.append(inputs[0].untyped_storage().nbytes())
+    )
+    model.read_out_from_layers(prompts, range(small_config["n_layer"] + 1))
+    last_position_bytes = len(prompts) * small_config["n_embd"] * 4
+    assert storage_sizes == [last_position_bytes] * (small_config["n_layer"] + 1)
+
+
+def test_mixed_length_batches_match_single_prompts(small_config):
+    torch.manual_seed(0)
+    model = ReasoningModel(small_config)
+    model.model.eval()
+    prompts = ["A=1\nB=", "#\nA=1\nB=0\nC=", "#\nC=0\nD=", "E=1\nD=0\nC=1\nB="]
+    all_layers = range(small_config["n_layer"] + 1)
+
+    batched = model.read_out_from_layers(prompts, all_layers)
+    bucketed = model.read_out_bucketed(prompts, all_layers, max_batch_size=2)
+    next_token_logits = model.get_next_token_logits(prompts)
+    for i, prompt in enumerate(prompts):
+        single = model.read_out_from_layers([prompt], all_layers)
+        for layer in all_layers:
+            assert torch.allclose(batched[layer][i], single[layer][0], atol=1e-5)
+            assert torch.allclose(bucketed[layer][i], single[layer][0], atol=1e-5)
+        with torch.no_grad():
+            single_next_token_logits = model.get_next_token_logits([prompt])
+        assert torch.allclose(next_token_logits[i], single_next_token_logits, atol=1e-5)
+
+
+def test_get_training_batch_default_rng(small_config):
+    samples = [f"A={a}\nB={b}" for a in (0, 1) for b in (0, 1)]
+    model = ReasoningModel(small_config, training_dataset_type="batch-with-separator", random_seed=1)
+    first, second = model.get_training_batch(samples), model.get_training_batch(samples)
+    assert first != second
+
+    # a model with the same seed draws the same sequence of batches
+    model_again = ReasoningModel(small_config, training_dataset_type="batch-with-separator", random_seed=1)
+    assert model_again.get_training_batch(samples) == first
+    assert model_again.get_training_batch(samples) == second
@@ -0,0 +1,39 @@
+from torch.optim import Adam
+from src.search import successive_halving
+from src.train import setup_training
+
+
+def make_config(lr, criterion_threshold=0.99):
+    return {
+        "true_model_path": "data/chains/chain_0.xbn",
+        "model_config": {"vocab_size": 257, "n_positions": 512, "n_embd": 32, "n_layer": 1, "n_head": 2},
+        "optimizer": Adam,
+        "optimizer_args": {"lr": lr},
+        "scheduler": None,
+        "scheduler_args": {},
+        "training_dataset_type": "batch-with-separator",
+        "criterion_threshold": criterion_threshold,
+    }
+
+
+def test_train_to_criterion_budget():
+    model, training_samples, _ = setup_training(make_config(1e-3))
+    assert not model.train_to_criterion(training_samples, threshold=0.99, max_iterations=3)
+    assert len(model.accuracy_history) == 3
+
+    # training continues from where it stopped
+    assert not model.train_to_criterion(training_samples, threshold=0.99, max_iterations=5)
+    assert len(model.accuracy_history) == 5
+
+
+def test_successive_halving():
+    # with an unreachable criterion, every config is eventually stopped by the search
+    configs = [make_config(lr, criterion_threshold=1.01) for lr in (1e-5, 1e-4, 1e-3, 1e-2)]
+    results = successive_halving(configs, min_iterations=2, max_iterations=8, eta=2)
+
+    assert sorted(r["config_idx"] for r in results) == [0, 1, 2, 3]
+    assert not any(r["reached_criterion"] for r in results)
+    # two configs are stopped after the first round, one after the second and one at the max budget
+    assert sorted(r["iterations"] for r in results) == [2, 2, 4, 8]
+    assert sorted(r["stopped_at_round"] for r in results) == [0, 0, 1, 2]
+    assert all(r["seconds"] > 0 for r in results)
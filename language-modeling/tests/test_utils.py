@@ -1,4 +1,5 @@
-from src.utils import ZERO_TOKEN, ONE_TOKEN, distance_in_graph
+from src.utils import ZERO_TOKEN, ONE_TOKEN, distance_in_graph, derive_seed, get_rng, bucket_by_length
+import numpy as np
 from transformers import AutoTokenizer
 from pgmpy.models import BayesianNetwork
 
@@ -26,4 +27,23 @@ def test_distance_in_graph():
     assert distance_in_graph(true_model, "B", "C") == 1
     assert distance_in_graph(true_model, "B", "D") == 2
     assert distance_in_graph(true_model, "D", "B") == 2
-    assert distance_in_graph(true_model, "E", "A") == 4
\ No newline at end of file
+    assert distance_in_graph(true_model, "E", "A") == 4
+
+def test_get_rng():
+    assert derive_seed(0, "model", ("A", 0, "E"), 3) == derive_seed(0, "model", ("A", 0, "E"), 3)
+    assert derive_seed(0, "model", 1) != derive_seed(0, "model", "1")
+    assert derive_seed(0, "model", 1) != derive_seed(1, "model", 1)
+    # numpy scalars, e.g. from a query read back with pandas, give the same streams as Python values
+    assert derive_seed(0, "A", np.int64(0)) == derive_seed(0, "A", 0)
+    assert derive_seed(0, (np.str_("A"), np.int64(1), "E")) == derive_seed(0, ("A", 1, "E"))
+
+    draws = get_rng(2024, "A", 1).random(5)
+    get_rng(2024, "B", 0).random(100)
+    assert (get_rng(2024, "A", 1).random(5) == draws).all()
+
+
+def test_bucket_by_length():
+    lengths = [5, 2, 9, 2, 5, 7]
+    batches = bucket_by_length(lengths, 2)
+    assert batches == [[1, 3], [0, 4], [5, 2]]
+    assert sorted(i for batch in bucket_by_length(lengths, 4) for i in batch) == list(range(6))